@@ -4,11 +4,14 @@ import os
 import logging
 import sqlite3
 import httpx
+import orjson
 import asyncio
 import datetime
 import re
+import time
 from dotenv import load_dotenv
-from collections import defaultdict, Counter
+from cachetools import TTLCache
+from collections import Counter
 from telegram import (
     Update,
     InlineKeyboardMarkup,
@@ -31,27 +34,153 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 BOT_USERNAME = "robotutor_bot"  # without @
 
+# Matched against raw group messages; re.IGNORECASE avoids lowercasing
+# a copy of every message just to check for a mention.
+MENTION_RE = re.compile(rf"{re.escape(BOT_USERNAME)}|john", re.IGNORECASE)
+
+# Words counted as study topics when messages are tokenized for /progress.
+TOPIC_RE = re.compile(r'\b[a-z]{4,}\b')
+
 logging.basicConfig(level=logging.INFO)
 
+# -----------------------------#
+# Groq HTTP Client
+# -----------------------------#
+# One pooled client for the process: keeps TCP+TLS connections to
+# api.groq.com alive between questions instead of handshaking per call.
+GROQ_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+)
+GROQ_HEADERS = {
+    "Authorization": f"Bearer {GROQ_API_KEY}",
+    "Content-Type": "application/json",
+}
+
+async def close_groq_client(application):
+    await GROQ_CLIENT.aclose()
+
+SYSTEM_MSG = {"role": "system", "content": "You're an intelligent tutor for grades 6–12. Be clear and friendly."}
+
+# Classrooms repeat questions; identical ones skip the API for an hour.
+ANSWER_CACHE = TTLCache(maxsize=512, ttl=3600)
+
+async def ask_groq(question: str) -> str:
+    key = question.strip().lower()
+    cached = ANSWER_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    response = await GROQ_CLIENT.post(
+        "https://api.groq.com/openai/v1/chat/completions",
+        headers=GROQ_HEADERS,
+        json={
+            "model": "llama3-8b-8192",
+            "messages": [SYSTEM_MSG, {"role": "user", "content": question}],
+        },
+    )
+    result = orjson.loads(response.content)
+    reply = result["choices"][0]["message"]["content"]
+    ANSWER_CACHE[key] = reply
+    return reply
+
 # -----------------------------#
 # DB Setup
 # -----------------------------#
-conn = sqlite3.connect("schedule.db", check_same_thread=False)
-c = conn.cursor()
+DB_PATH = "schedule.db"
 
-c.execute("""CREATE TABLE IF NOT EXISTS chat_history (
-    user_id INTEGER,
-    timestamp TEXT,
-    user_message TEXT,
-    bot_reply TEXT
-)""")
+conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+c = conn.cursor()
 
-conn.commit()
+# WAL lets /progress and /history reads run while the writer commits,
+# and synchronous=NORMAL drops the double-fsync of the rollback journal.
+# Pragmas only make sense for an on-disk DB.
+if DB_PATH != ":memory:":
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA cache_size=-30000")
+    c.execute("PRAGMA busy_timeout=5000")
+
+# One transaction for all of the schema setup.
+with conn:
+    # Older DBs declared timestamp TEXT and stored ISO-8601 strings; TEXT
+    # affinity would coerce even converted values back to strings, so the
+    # table has to be rebuilt once with INTEGER affinity and epoch values.
+    legacy = any(
+        col[1] == "timestamp" and col[2].upper() == "TEXT"
+        for col in c.execute("PRAGMA table_info(chat_history)")
+    )
+    if legacy:
+        c.execute("ALTER TABLE chat_history RENAME TO chat_history_legacy")
+
+    c.execute("""CREATE TABLE IF NOT EXISTS chat_history (
+        user_id INTEGER,
+        timestamp INTEGER,
+        user_message TEXT,
+        bot_reply TEXT
+    )""")
+
+    if legacy:
+        c.execute("""INSERT INTO chat_history
+                     SELECT user_id,
+                            CAST(strftime('%s', timestamp) AS INTEGER),
+                            user_message,
+                            bot_reply
+                     FROM chat_history_legacy""")
+        c.execute("DROP TABLE chat_history_legacy")
+
+    # Per-day word counts, maintained by the background writer so /progress
+    # is a single aggregate query instead of re-tokenizing every message.
+    c.execute("""CREATE TABLE IF NOT EXISTS topic_counts (
+        user_id INTEGER,
+        word TEXT,
+        day INTEGER,
+        n INTEGER
+    )""")
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ch_user_ts ON chat_history(user_id, timestamp DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tc ON topic_counts(user_id, day)")
 
 # -----------------------------#
-# Memory Store
+# Background DB Writer
 # -----------------------------#
-user_sessions = defaultdict(list)
+# Handlers enqueue rows instead of paying the INSERT + fsync before
+# replying; this task drains the queue and commits in batches.
+INSERT_Q: asyncio.Queue = asyncio.Queue()
+
+async def db_writer():
+    while True:
+        batch = [await INSERT_Q.get()]
+        try:
+            while len(batch) < 50:
+                batch.append(await asyncio.wait_for(INSERT_Q.get(), timeout=0.2))
+        except asyncio.TimeoutError:
+            pass
+
+        topic_rows = []
+        for user_id, ts, question, _reply in batch:
+            day = ts // 86400
+            for word, n in Counter(TOPIC_RE.findall(question.lower())).items():
+                topic_rows.append((user_id, word, day, n))
+
+        # A failed flush must not kill the loop, or every later row would
+        # pile up in INSERT_Q unpersisted and unlogged.
+        try:
+            with conn:
+                c.executemany("""INSERT INTO chat_history (user_id, timestamp, user_message, bot_reply)
+                                 VALUES (?, ?, ?, ?)""", batch)
+                if topic_rows:
+                    c.executemany("""INSERT INTO topic_counts (user_id, word, day, n)
+                                     VALUES (?, ?, ?, ?)""", topic_rows)
+        except Exception:
+            logging.exception("Failed to flush %d chat row(s); batch dropped", len(batch))
+
+async def start_db_writer(application):
+    # The application holds the task reference so it can't be
+    # garbage-collected mid-flight.
+    application.create_task(db_writer())
 
 # -----------------------------#
 # /start
@@ -67,27 +196,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------------#
 async def show_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    seven_days_ago = (datetime.datetime.now() - datetime.timedelta(days=7)).isoformat()
+    seven_days_ago = int(time.time()) // 86400 - 7
 
     c.execute("""
-        SELECT user_message FROM chat_history
-        WHERE user_id = ? AND timestamp > ?
+        SELECT word, SUM(n) FROM topic_counts
+        WHERE user_id = ? AND day > ?
+        GROUP BY word ORDER BY 2 DESC LIMIT 5
     """, (user_id, seven_days_ago))
-    rows = c.fetchall()
-
-    if not rows:
-        await update.message.reply_text("😕 No progress to show yet. Start asking questions!")
-        return
-
-    topic_keywords = []
-    for row in rows:
-        msg = row[0].lower()
-        words = re.findall(r'\b[a-z]{4,}\b', msg)
-        topic_keywords.extend(words)
+    common = c.fetchall()
 
-    common = Counter(topic_keywords).most_common(5)
     if not common:
-        await update.message.reply_text("😅 Couldn't detect topics, but you're asking good questions!")
+        await update.message.reply_text("😕 No progress to show yet. Start asking questions!")
         return
 
     msg = "📊 *Your Study Progress (Last 7 Days)*\n\n"
@@ -100,8 +219,27 @@ async def show_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------------#
 # /history
 # -----------------------------#
+# Rendered /history text per user, keyed by the max rowid seen; a new
+# row for the user changes MAX(rowid) and invalidates the entry.
+HISTORY_CACHE: dict[int, tuple[int, str]] = {}
+
+def clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
 async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    c.execute("SELECT MAX(rowid) FROM chat_history WHERE user_id = ?", (user_id,))
+    max_rowid = c.fetchone()[0]
+
+    if max_rowid is None:
+        await update.message.reply_text("No history found yet. Start chatting!")
+        return
+
+    cached = HISTORY_CACHE.get(user_id)
+    if cached and cached[0] == max_rowid:
+        await update.message.reply_text(cached[1], parse_mode="Markdown")
+        return
+
     c.execute("""
         SELECT timestamp, user_message, bot_reply FROM chat_history
         WHERE user_id = ?
@@ -109,15 +247,15 @@ async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """, (user_id,))
     rows = c.fetchall()
 
-    if not rows:
-        await update.message.reply_text("No history found yet. Start chatting!")
-        return
-
-    for t, user_msg, bot_reply in reversed(rows):
-        await update.message.reply_text(
-            f"🕓 *{t.split('T')[1][:5]}*\n👤 You: {user_msg}\n🤖 Bot: {bot_reply}",
-            parse_mode="Markdown"
-        )
+    # Clipped so ten entries always fit Telegram's 4096-char message
+    # limit; full replies would blow past it and fail the send.
+    msg = "\n\n".join(
+        f"🕓 *{datetime.datetime.fromtimestamp(t).strftime('%H:%M')}*\n"
+        f"👤 You: {clip(user_msg, 100)}\n🤖 Bot: {clip(bot_reply, 200)}"
+        for t, user_msg, bot_reply in reversed(rows)
+    )
+    await update.message.reply_text(msg, parse_mode="Markdown")
+    HISTORY_CACHE[user_id] = (max_rowid, msg)
 # -----------------------------#
 # Handle DM Questions (No Command)
 # -----------------------------#
@@ -133,38 +271,20 @@ async def handle_private_question(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text("🤔 Please send a valid question.")
         return
 
-    await update.message.reply_text("🤖 Thinking...")
+    # Edited in place once the answer arrives: one Telegram call instead
+    # of a second send, and the user sees a single evolving bubble.
+    thinking = await update.message.reply_text("🤖 Thinking...")
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "llama3-8b-8192",
-                    "messages": [
-                        {"role": "system", "content": "You're an intelligent tutor for grades 6–12. Be clear and friendly."},
-                        {"role": "user", "content": question}
-                    ]
-                },
-                timeout=30
-            )
-            result = response.json()
-            reply = result["choices"][0]["message"]["content"]
-
-            # Save to DB
-            c.execute("""INSERT INTO chat_history (user_id, timestamp, user_message, bot_reply)
-                         VALUES (?, ?, ?, ?)""",
-                      (user_id, datetime.datetime.now().isoformat(), question, reply))
-            conn.commit()
-
-            await update.message.reply_text(f"📬 Answer:\n\n{reply}")
+        reply = await ask_groq(question)
+
+        # Save to DB
+        INSERT_Q.put_nowait((user_id, int(time.time()), question, reply))
+
+        await thinking.edit_text(f"📬 Answer:\n\n{reply}")
 
     except Exception as e:
-        await update.message.reply_text("❌ Error fetching answer.")
+        await thinking.edit_text("❌ Error fetching answer.")
         print("Error:", e)
 
 # -----------------------------#
@@ -176,9 +296,8 @@ async def handle_group_mention(update: Update, context: ContextTypes.DEFAULT_TYP
 
     user = update.effective_user
     user_mention = f"@{user.username}" if user.username else user.first_name
-    text = update.message.text.lower()
 
-    if BOT_USERNAME not in text and "john" not in text:
+    if not MENTION_RE.search(update.message.text):
         return  # Ignore if bot is not mentioned
 
     context.user_data["group_question"] = update.message.text
@@ -210,35 +329,15 @@ async def answer_destination_callback(update: Update, context: ContextTypes.DEFA
 
     # Call LLM
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "llama3-8b-8192",
-                    "messages": [
-                        {"role": "system", "content": "You're an intelligent tutor for grades 6–12. Be clear and friendly."},
-                        {"role": "user", "content": question}
-                    ]
-                },
-                timeout=30
-            )
-            result = response.json()
-            reply = result["choices"][0]["message"]["content"]
-
-            # Save to DB
-            c.execute("""INSERT INTO chat_history (user_id, timestamp, user_message, bot_reply)
-                         VALUES (?, ?, ?, ?)""",
-                      (user_id, datetime.datetime.now().isoformat(), question, reply))
-            conn.commit()
-
-            if query.data == "group":
-                await query.message.reply_text(f"📢 Answer:\n{reply}")
-            else:
-                await context.bot.send_message(chat_id=user_id, text=f"📬 Here's your answer:\n\n{reply}")
+        reply = await ask_groq(question)
+
+        # Save to DB
+        INSERT_Q.put_nowait((user_id, int(time.time()), question, reply))
+
+        if query.data == "group":
+            await query.message.reply_text(f"📢 Answer:\n{reply}")
+        else:
+            await context.bot.send_message(chat_id=user_id, text=f"📬 Here's your answer:\n\n{reply}")
 
     except Exception as e:
         await query.message.reply_text("❌ Error fetching answer.")
@@ -247,7 +346,13 @@ async def answer_destination_callback(update: Update, context: ContextTypes.DEFA
 # -----------------------------#
 # App Setup
 # -----------------------------#
-app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+app = (
+    ApplicationBuilder()
+    .token(TELEGRAM_TOKEN)
+    .post_init(start_db_writer)
+    .post_shutdown(close_groq_client)
+    .build()
+)
 app.add_handler(CommandHandler("start", start))
 app.add_handler(CommandHandler("progress", show_progress))
 app.add_handler(CommandHandler("history", show_history))